@@ -1,208 +1,1009 @@
-import chess, chess.pgn, chess.engine
+import chess, chess.pgn, chess.engine, chess.polyglot
 import bz2, requests, gzip
-import collections, heapq
+import bisect, heapq, itertools
 import os.path, pickle
-import math, random
+import math, random, struct
 import argparse, datetime, urllib
+import re
 import asyncio
+import concurrent.futures, multiprocessing, queue
+import io, shutil, subprocess, threading
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# We use the standard polyglot randoms, so keys are stable across runs
+# (in particular across PYTHONHASHSEED values) and dumped trees stay valid.
+# No siphash/xxhash anywhere: position and move keys are pure xor of these
+# fixed tables, which is as fast as hashing gets.
+zobrist = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def piece_square_random(piece_type, color, square):
+    return chess.polyglot.POLYGLOT_RANDOM_ARRAY[
+            64 * ((piece_type - 1) * 2 + color) + square]
+
+
+# Randoms for (position, move) keys, xor-ed onto the position key below.
+# Generated from a fixed seed, so keys stay stable across runs. One flat
+# table indexed by from << 6 | to, saving a list indirection per lookup.
+_move_rnd = random.Random(0xC4E55E)
+MOVE_RANDOM = [_move_rnd.getrandbits(64) for _ in range(64 * 64)]
+# Index 0 is zero, so moves without a promotion add no term
+PROMO_RANDOM = [0] + [_move_rnd.getrandbits(64) for _ in range(6)]
+del _move_rnd
+
+
+def move_key(key, move):
+    """ The key of a (position, move) pair. A couple of xors, with no tuple
+        allocation or tuple hashing on the ingest and search hot paths. """
+    return key ^ MOVE_RANDOM[move.from_square << 6 | move.to_square] \
+               ^ PROMO_RANDOM[move.promotion or 0]
+
+
+def _pack_move(move):
+    """ Packs a move into 16 bits: from | to << 6 | promotion << 12.
+        None (an engine eval with no pv) becomes the sentinel 0xFFFF. """
+    if move is None:
+        return 0xFFFF
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def _unpack_move(packed):
+    if packed == 0xFFFF:
+        return None
+    return chess.Move(packed & 63, packed >> 6 & 63, packed >> 12 or None)
+
+
+def _pack_value(move, score):
+    """ An etree value packed into one int: the move in the high bits, the
+        float32 score bits in the low ones. A plain int is an order of
+        magnitude smaller than a (Move, float) tuple, which adds up over
+        millions of entries. """
+    return _pack_move(move) << 32 | struct.unpack('<I', struct.pack('<f', score))[0]
+
+
+def _value_move(value):
+    return _unpack_move(value >> 32)
+
+
+def _value_score(value):
+    return struct.unpack('<f', struct.pack('<I', value & 0xFFFFFFFF))[0]
+
+
+# Marks a node the search has entered but not finished. Packed values only
+# use the low 48 bits, so this can never collide with one.
+OPEN = 2**64 - 1
+
+
+def _open_maybe_gzip(path):
+    """ Opens our dumps, which are gzipped nowadays, but old plain pickles
+        should still load. """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class ZobristBoard(chess.Board):
+    """
+    A chess.Board maintaining a 64 bit Zobrist key of the position.
+    board._transposition_key() rebuilds a tuple of bitboards on every call;
+    keeping the key up to date with a few XORs per push is much cheaper on
+    the hot paths — both the ingest replay in update_tree and every node of
+    the expectimax search read the key at least once per move.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.zob_key = zobrist(self)
+        self._zob_stack = []
+
+    def push(self, move):
+        self._zob_stack.append(self.zob_key)
+        key = self.zob_key
+        # The castling, en passant and turn terms depend on more than the
+        # move itself, so we XOR the old terms out and the new ones back in
+        # around the push.
+        key ^= zobrist.hash_castling(self) ^ zobrist.hash_ep_square(self) \
+                ^ zobrist.hash_turn(self)
+        if move:
+            color = self.turn
+            piece = self.piece_type_at(move.from_square)
+            key ^= piece_square_random(piece, color, move.from_square)
+            if self.is_en_passant(move):
+                cap_square = move.to_square + (-8 if color else 8)
+                key ^= piece_square_random(chess.PAWN, not color, cap_square)
+            else:
+                captured = self.piece_type_at(move.to_square)
+                if captured is not None:
+                    key ^= piece_square_random(captured, not color, move.to_square)
+            if self.is_castling(move):
+                if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+                    rook_from, rook_to = move.to_square + 1, move.to_square - 1
+                else:
+                    rook_from, rook_to = move.to_square - 2, move.to_square + 1
+                key ^= piece_square_random(chess.ROOK, color, rook_from) \
+                        ^ piece_square_random(chess.ROOK, color, rook_to)
+            key ^= piece_square_random(move.promotion or piece, color, move.to_square)
+        super().push(move)
+        key ^= zobrist.hash_castling(self) ^ zobrist.hash_ep_square(self) \
+                ^ zobrist.hash_turn(self)
+        self.zob_key = key
+
+    def pop(self):
+        move = super().pop()
+        self.zob_key = self._zob_stack.pop()
+        return move
+
+    def copy(self, *, stack=True):
+        board = super().copy(stack=stack)
+        board.zob_key = self.zob_key
+        board._zob_stack = list(self._zob_stack) if stack else []
+        return board
 
 
 class Engine:
     def __init__(self, ucipath, search_time, threads):
         """
-        Spawn a new uci engine from the given path.
+        Spawn a pool of uci engines from the given path.
         """
-        self.engine = None
+        self.pool = []
         self.search_time = search_time
         self.threads = threads
         self.ucipath = ucipath
         self.evals = 0
+        # Transpositions make the search request the same position over
+        # several paths; one engine call per position is enough. search_time
+        # is fixed per Engine, so the position key alone can be the cache key.
+        self.cache = {}
 
     def start(self):
-        self.engine = chess.engine.SimpleEngine.popen_uci(self.ucipath)
-        self.engine.configure({'Threads': self.threads})
+        # We run `threads` single-threaded engines rather than one engine with
+        # `threads` threads. Lazy-SMP scales sublinearly, so for throughput on
+        # many independent positions separate processes are better.
+        self.pool = [chess.engine.SimpleEngine.popen_uci(self.ucipath)
+                     for _ in range(self.threads)]
+        for engine in self.pool:
+            options = {'Threads': 1}
+            if 'Hash' in engine.options:
+                # A decent sized hash table, so positions searched for one
+                # sibling warm-start its neighbours.
+                options['Hash'] = 256
+            engine.configure(options)
+        # One session token for the whole run: python-chess only sends
+        # ucinewgame when the game changes, so this keeps each engine's
+        # hash table warm between analyse calls.
+        self.session = object()
+        self.idle = queue.SimpleQueue()
+        for engine in self.pool:
+            self.idle.put(engine)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
 
-    def evaluate(self, board):
-        """
-        Evaluate the board using the given engine.
-        Returns the best move as well as the score from the perspective
-        of the current player in the range [0, 1].
-        If no move is returned by the engine, the move is None.
-        """
+    def quit(self):
+        """ Shuts down the engine processes. SimpleEngine has no finalizer,
+            so without this a multi-month run strands one pool per month. """
+        if self.pool:
+            self.executor.shutdown(wait=True)
+            for engine in self.pool:
+                engine.quit()
+            self.pool = []
+
+    def _analyse(self, engine, board):
         self.evals += 1
         try:
-            info = self.engine.analyse(board, chess.engine.Limit(time=self.search_time))
+            # We only read the score and the first pv move, so don't have the
+            # protocol layer parse and store every other info line the engine
+            # chatters at us.
+            info = engine.analyse(board, chess.engine.Limit(time=self.search_time),
+                                  info=chess.engine.INFO_SCORE | chess.engine.INFO_PV,
+                                  game=self.session)
         except asyncio.exceptions.TimeoutError:
+            # None rather than a result, so callers don't cache the fallback
+            # score and a later visit retries the engine.
             print('Warning: Timeout in analysis')
-            return None, 0
+            return None
         wp = info['score'].relative.wdl().expectation()
         if 'pv' in info:
             move = info['pv'][0]
         else: move = None
         return move, wp
 
+    def evaluate(self, board):
+        """
+        Evaluate the board using the given engine.
+        Returns the best move as well as the score from the perspective
+        of the current player in the range [0, 1].
+        If no move is returned by the engine, the move is None.
+        """
+        hit = self.cache.get(board.zob_key)
+        if hit is not None:
+            return hit
+        engine = self.idle.get()
+        try:
+            res = self._analyse(engine, board)
+        finally:
+            self.idle.put(engine)
+        if res is None: # Timeout; don't poison the cache with the fallback
+            return None, 0
+        self.cache[board.zob_key] = res
+        return res
+
+    def evaluate_many(self, boards):
+        """
+        Evaluate a batch of boards in parallel over the engine pool.
+        Returns a list of evaluate() results in the same order as the boards.
+        The batches we get are siblings that share almost the whole position,
+        so each engine takes a contiguous run of the batch and keeps its hash
+        table warm between them, instead of paying an engine checkout and a
+        cold start per board.
+        """
+        todo, seen = [], set()
+        for board in boards:
+            key = board.zob_key
+            if key not in self.cache and key not in seen:
+                seen.add(key)
+                todo.append(board)
+        if todo:
+            size = -(-len(todo) // max(len(self.pool), 1))
+            runs = [todo[i:i+size] for i in range(0, len(todo), size)]
+            def analyse_run(run):
+                engine = self.idle.get()
+                try:
+                    return [self._analyse(engine, board) for board in run]
+                finally:
+                    self.idle.put(engine)
+            for run, results in zip(runs, self.executor.map(analyse_run, runs)):
+                for board, res in zip(run, results):
+                    if res is not None: # Timeouts stay uncached, as above
+                        self.cache[board.zob_key] = res
+        return [self.cache.get(board.zob_key, (None, 0)) for board in boards]
+
+
+class HTree:
+    """
+    A Counter-like visits map. Integer (Zobrist) keys are compacted into
+    sorted numpy arrays, 10 bytes per entry rather than the ~100 bytes a dict
+    entry costs, and looked up by binary search. Fresh increments, and the
+    rare counts too big for the arrays, live in a small dict overlay
+    until the next compact().
+    """
+
+    def __init__(self):
+        self.extra = {}
+        self.segments = [] # list of (sorted uint64 keys, uint16 counts)
+
+    def add(self, key):
+        """ Adds one to the count of key, without computing the total. """
+        extra = self.extra
+        extra[key] = extra.get(key, 0) + 1
+
+    def inc_seen(self, key):
+        """ Adds one to the count of key and returns whether the key had
+            been seen before. Only probes the compacted segments on the
+            first overlay sighting, when the answer could still be no. """
+        cnt = self.extra.get(key, 0) + 1
+        self.extra[key] = cnt
+        return cnt > 1 or self._compacted(key) > 0
+
+    def _compacted(self, key):
+        cnt = 0
+        for keys, vals in self.segments:
+            # bisect, not np.searchsorted: handed a python int, searchsorted
+            # falls off its fast path and recasts the whole uint64 segment
+            # on every probe, which is several hundred times slower.
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                cnt += int(vals[i])
+        return cnt
+
+    def __getitem__(self, key):
+        return self.extra.get(key, 0) + self._compacted(key)
+
+    def get_many(self, keys):
+        """ Looks up a whole list of keys at once. One vectorized binary
+            search per segment, instead of a Python-level probe per key. """
+        keys = np.asarray(keys, dtype=np.uint64)
+        if self.extra:
+            get = self.extra.get
+            counts = np.fromiter((get(int(key), 0) for key in keys),
+                                 dtype=np.uint32, count=len(keys))
+        else:
+            counts = np.zeros(len(keys), dtype=np.uint32)
+        for skeys, svals in self.segments:
+            if not len(skeys):
+                continue
+            idx = np.minimum(np.searchsorted(skeys, keys), len(skeys) - 1)
+            hits = skeys[idx] == keys
+            counts[hits] += svals[idx[hits]]
+        return counts
+
+    def __len__(self):
+        return len(self.extra) + sum(len(keys) for keys, _ in self.segments)
+
+    def __iadd__(self, other):
+        extra = self.extra
+        if isinstance(other, HTree):
+            for key, val in other.extra.items():
+                extra[key] = extra.get(key, 0) + val
+            # Keep loaded months as separate sorted segments; merging eagerly
+            # would rescan every accumulated entry once per loaded month.
+            # compact() folds them together when we want a single segment.
+            self.segments += getattr(other, 'segments', [])
+        else:
+            # Counters from old pickles. Dumps from before the zobrist keys
+            # used _transposition_key() and (key, move) tuples; nothing can
+            # look those up anymore, so refuse them rather than merge junk
+            # that only blows up at the next compact().
+            if any(not isinstance(key, int) for key in other):
+                raise ValueError(
+                    'htree dump predates zobrist keys; rebuild it with update_tree')
+            for key, val in other.items():
+                extra[key] = extra.get(key, 0) + val
+        return self
+
+    def compact(self):
+        """ Folds the overlay and all segments into a single sorted segment. """
+        keys_list = [keys for keys, _ in self.segments]
+        vals_list = [vals.astype(np.uint32) for _, vals in self.segments]
+        if self.extra:
+            keys_list.append(np.fromiter(self.extra.keys(), dtype=np.uint64,
+                                         count=len(self.extra)))
+            vals_list.append(np.fromiter(self.extra.values(), dtype=np.uint32,
+                                         count=len(self.extra)))
+            self.extra.clear()
+        if not keys_list:
+            return
+        keys = np.concatenate(keys_list)
+        vals = np.concatenate(vals_list)
+        order = np.argsort(keys, kind='stable')
+        keys, vals = keys[order], vals[order]
+        # Duplicate keys have their counts summed
+        keys, starts = np.unique(keys, return_index=True)
+        sums = np.add.reduceat(vals, starts) if len(vals) else vals
+        # Counts only feed the expand-treshold test and probability ratios,
+        # so uint16 is plenty. The rare entry seen 65535+ times keeps full
+        # precision in the overlay instead.
+        big = sums >= 1 << 16
+        for key, val in zip(keys[big], sums[big]):
+            # The overlay was just cleared, so plain assignment is enough
+            self.extra[int(key)] = int(val)
+        self.segments = [(keys[~big], sums[~big].astype(np.uint16))]
+
+    def trim(self, floor=2):
+        """ Drops entries with a count below floor. The bulk of the table is
+            positions and moves seen exactly once, which can never pass the
+            expand treshold and carry almost no probability weight, yet
+            dominate memory. """
+        self.compact()
+        if not self.segments:
+            return
+        keys, vals = self.segments[0]
+        mask = vals >= floor
+        self.segments = [(keys[mask], vals[mask])]
+
+
+class BackgroundDecompressor(io.RawIOBase):
+    """
+    Decompresses a bz2 or zstd stream on a background thread, feeding a
+    bounded queue, so download and decompression overlap with the PGN parsing
+    that happens on the main thread.
+    """
+
+    def __init__(self, raw, format='bz2', chunk_size=1 << 22, max_chunks=32):
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.buffer = b''
+        self.eof = False
+        self._stop = False
+        self.thread = threading.Thread(target=self._worker,
+                                       args=(raw, format, chunk_size), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _new_decomp(format):
+        if format == 'zst':
+            return zstandard.ZstdDecompressor().decompressobj()
+        return bz2.BZ2Decompressor()
+
+    def _worker(self, raw, format, chunk_size):
+        decomp = self._new_decomp(format)
+        try:
+            data = raw.read(chunk_size)
+            while data and not self._stop:
+                out = decomp.decompress(data)
+                if out and not self._put(out):
+                    return
+                if getattr(decomp, 'eof', False):
+                    # The lichess archives are multi-stream/multi-frame, so
+                    # keep going with a fresh decompressor.
+                    data = decomp.unused_data
+                    decomp = self._new_decomp(format)
+                    if not data:
+                        data = raw.read(chunk_size)
+                else:
+                    data = raw.read(chunk_size)
+        except Exception as e:
+            if not self._stop:
+                print('Warning: Error in download thread:', e)
+        self._put(b'') # Sentinel
+
+    def _put(self, chunk):
+        while not self._stop:
+            try:
+                self.queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            if self.eof:
+                return 0
+            chunk = self.queue.get()
+            if not chunk:
+                self.eof = True
+                return 0
+            # A memoryview, so handing out the chunk below slices for free
+            # instead of copying the multi-MB tail on every read.
+            self.buffer = memoryview(chunk)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self._stop = True
+        super().close()
+
+
+def _external_bz2(raw, chunk_size=1 << 22):
+    """ Streams raw through an external bzip2, or returns None when no
+        binary is installed. The python bz2 module is single threaded and
+        GIL bound; lbzip2/pbzip2 decompress on all cores. The http stream
+        has no file descriptor, so a small thread pumps it into the child.
+    """
+    for cmd in (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzcat']):
+        if shutil.which(cmd[0]):
+            break
+    else:
+        return None
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=chunk_size)
+    def pump():
+        try:
+            while True:
+                data = raw.read(chunk_size)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+    threading.Thread(target=pump, daemon=True).start()
+    return proc.stdout
+
+
+_comment_re = re.compile(r'\{[^}]*\}')
+_fen_re = re.compile(r'\[FEN "([^"]*)"\]')
+_result_tokens = {'1-0', '0-1', '1/2-1/2', '*'}
+
+
+def _game_key_pairs(text):
+    """
+    Parses one raw pgn game and returns its mainline as pre-hashed
+    (position key, move key) pairs. Runs in the parser worker processes.
+    A hand-rolled san tokenizer: chess.pgn.read_game allocates a Game node
+    per ply plus comment/variation machinery we never look at, and only the
+    mainline moves matter here.
+    """
+    fen = _fen_re.search(text)
+    try:
+        board = ZobristBoard(fen.group(1)) if fen else ZobristBoard()
+    except ValueError:
+        return _game_key_pairs_pgn(text)
+    movetext = '\n'.join(line for line in _comment_re.sub(' ', text).splitlines()
+                         if not line.startswith('['))
+    pairs = []
+    depth = 0
+    parse_san, push, append = board.parse_san, board.push, pairs.append
+    for token in movetext.split():
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth or token[0] == '$' or token in _result_tokens:
+            # Inside a variation, a NAG, or the game result
+            continue
+        else:
+            # Strip a glued move number, as in '12.Nf3' or '12...Nf3'
+            token = token.rsplit('.', 1)[-1]
+            if not token:
+                continue
+            key = board.zob_key
+            try:
+                move = parse_san(token)
+            except ValueError:
+                # Anything surprising goes through the full parser instead
+                return _game_key_pairs_pgn(text)
+            append((key, move_key(key, move)))
+            push(move)
+    return pairs
+
+
+def _game_key_pairs_pgn(text):
+    """ The chess.pgn fallback for games the tokenizer balks at. """
+    try:
+        game = chess.pgn.read_game(io.StringIO(text))
+    except ValueError as ve:
+        # Up to August 2016: 7 games with illegal castling moves were recorded.
+        print('Warning: ValueError', ve)
+        return []
+    if game is None:
+        return []
+    board = ZobristBoard(game.board().fen())
+    pairs = []
+    for move in game.mainline_moves():
+        key = board.zob_key
+        pairs.append((key, move_key(key, move)))
+        board.push(move)
+    return pairs
+
 
 class GameDatabase:
-    archive_url = 'https://database.lichess.org/standard/lichess_db_standard_rated_{year:04d}-{month:02d}.pgn.bz2'
+    archive_url = 'https://database.lichess.org/standard/lichess_db_standard_rated_{year:04d}-{month:02d}.pgn.{ext}'
+    header_re = re.compile(r'\[(\w+) "(.*)"\]')
 
     def __init__(self):
-        self.htree = collections.Counter()
+        self.htree = HTree()
 
     def download_games(self, year, month, max_games, filters):
         """
         Download and parsse lichess games from year, month.
         """
-        url = self.archive_url.format(year=year, month=month)
+        for text in self._download_raw_games(year, month, max_games, filters):
+            try:
+                game = chess.pgn.read_game(io.StringIO(text))
+            except ValueError as ve:
+                # Up to August 2016: 7 games with illegal castling moves were recorded.
+                print('Warning: ValueError', ve)
+                continue
+            if game is None:
+                break
+            yield game
+
+    def _download_raw_games(self, year, month, max_games, filters):
+        """
+        Streams the raw pgn text of each game passing the filters, leaving
+        the actual parsing to whoever consumes it.
+        """
         # For some reason the lichess server now defaults to gzipping the bzip
         headers = {'Accept-Encoding': 'identity'}
-        with requests.get(url, headers=headers, stream=True) as r:
+        # The newer archives are also published as zstd, which decompresses
+        # several times faster than bzip2, so prefer that when the zstandard
+        # module is around, falling back to bz2 for the older months.
+        exts = ['zst', 'bz2'] if zstandard is not None else ['bz2']
+        for ext in exts:
+            url = self.archive_url.format(year=year, month=month, ext=ext)
+            r = requests.get(url, headers=headers, stream=True)
+            if r.status_code == 404 and ext != exts[-1]:
+                r.close()
+                continue
+            break
+        with r:
             r.raise_for_status()
-            with bz2.open(r.raw, 'rt') as b:
+            raw = _external_bz2(r.raw) if ext == 'bz2' else None
+            if raw is None:
+                raw = io.BufferedReader(BackgroundDecompressor(r.raw, ext), 1 << 20)
+            with io.TextIOWrapper(raw, encoding='utf-8') as b:
                 for _ in range(max_games):
                     try:
-                        game = chess.pgn.read_game(b)
-                    # read_game is supposed to return None if there are not more games,
-                    # but sometimes it appears to throw an EOFError instead.
+                        # For tight rating or time-control bands most games
+                        # fail the filters, so peek at the raw header lines
+                        # first and only pay for full parsing of the keepers.
+                        headers, lines = self._read_headers(b)
+                        if headers is None:
+                            break
+                        if not all(f(headers) for f in filters):
+                            self._skip_movetext(b)
+                            continue
+                        lines += self._read_movetext(b)
+                    # The stream is supposed to simply end when there are no
+                    # more games, but sometimes it throws an EOFError instead.
                     except EOFError:
                         print('Warning: EOFError')
                         break
                     except ConnectionResetError:
                         print('Warning: ConnectionResetError')
                         break
-                    except ValueError as ve:
-                        # Up to August 2016: 7 games with illegal castling moves were recorded.
-                        print('Warning: ValueError', ve)
-                        continue
-                    if game is None:
-                        break
-                    if not all(f(game.headers) for f in filters):
-                        continue
-                    yield game
+                    yield ''.join(lines)
+
+    def _read_headers(self, b):
+        """
+        Reads the header section of the next game without parsing any moves.
+        Returns a (tag -> value) dict plus the raw lines consumed, or None at
+        the end of the stream.
+        """
+        headers = {}
+        lines = []
+        while True:
+            line = b.readline()
+            if not line:
+                return None, lines
+            lines.append(line)
+            if not line.strip():
+                # Blank lines before the first header are allowed
+                if headers:
+                    return headers, lines
+            else:
+                match = self.header_re.match(line)
+                if match:
+                    headers[match.group(1)] = match.group(2)
+                else:
+                    # Movetext already started, i.e. a game without headers
+                    return headers, lines
+
+    def _skip_movetext(self, b):
+        """ Skips to the blank line ending the movetext of the current game. """
+        while True:
+            line = b.readline()
+            if not line or not line.strip():
+                return
+
+    def _read_movetext(self, b):
+        """ Reads through the blank line ending the movetext of the current game. """
+        lines = []
+        while True:
+            line = b.readline()
+            lines.append(line)
+            if not line or not line.strip():
+                return lines
 
     def update_tree(self, year, month, max_games, filters):
         """
         Add games to a position -> visits counter.
         """
-        games = self.download_games(year, month, max_games, filters)
+        texts = self._download_raw_games(year, month, max_games, filters)
+        # Bound locally, this loop is white hot
+        add, inc_seen = self.htree.add, self.htree.inc_seen
         i = -1 # In case there are no games
-        for i, game in enumerate(games):
-            board = game.board()
-            print(i, 'games processed', end='\r')
-            for j, move in enumerate(game.mainline_moves()):
-                key = board._transposition_key()
-                self.htree[key] += 1
-                self.htree[(key, move)] += 1
-                # We only allow a game to contribute one new position.
-                # This prevents our RAM from filling up with otherwise unseen
-                # positions, while not affecting useful posistions much.
-                if self.htree[key] == 1:
-                    break
-                board.push(move)
+        # Parsing pgn is pure python and much slower than counting, so fan
+        # the games out to a pool of parser processes and only apply the
+        # pre-hashed key pairs they send back here.
+        with multiprocessing.Pool() as pool:
+            for i, pairs in enumerate(pool.imap(_game_key_pairs, texts, chunksize=16)):
+                print(i, 'games processed', end='\r')
+                for key, mkey in pairs:
+                    add(mkey)
+                    # We only allow a game to contribute one new position.
+                    # This prevents our RAM from filling up with otherwise unseen
+                    # positions, while not affecting useful posistions much.
+                    if not inc_seen(key):
+                        break
         print(i+1, 'games processed')
+        self.htree.trim()
 
-    def get_board_count(self, board):
-        key = board._transposition_key()
+    def count(self, key):
         return self.htree[key]
 
+    def move_count(self, key, move):
+        return self.htree[move_key(key, move)]
+
+    def counts(self, keys):
+        """ The visit counts of all the given position keys at once. """
+        return self.htree.get_many(keys)
+
+    def move_counts(self, key, moves):
+        """ The play counts of all the given moves at once. """
+        return self.htree.get_many([move_key(key, move) for move in moves])
+
+    def get_board_count(self, board):
+        return self.htree[board.zob_key]
+
     def get_move_count(self, board, move):
-        key = board._transposition_key()
-        return self.htree[(key, move)]
+        return self.htree[move_key(board.zob_key, move)]
 
     def dump(self, path):
+        # Flat arrays in an npz: 10 bytes per entry and no per-int object
+        # reconstruction on load, unlike pickling a counter.
+        self.htree.compact()
+        if self.htree.segments:
+            keys, vals = self.htree.segments[0]
+        else:
+            keys = np.empty(0, dtype=np.uint64)
+            vals = np.empty(0, dtype=np.uint16)
+        extra = self.htree.extra
         with open(path, 'wb') as f:
-            pickle.dump(self.htree, f)
+            np.savez_compressed(
+                f, keys=keys, vals=vals,
+                extra_keys=np.fromiter(extra.keys(), dtype=np.uint64, count=len(extra)),
+                extra_vals=np.fromiter(extra.values(), dtype=np.uint64, count=len(extra)))
 
     def load_update(self, path):
         with open(path, 'rb') as f:
-            self.htree += pickle.load(f)
+            magic = f.read(2)
+        if magic == b'PK':
+            with np.load(path) as data:
+                self.htree.segments.append((data['keys'], data['vals']))
+                extra = self.htree.extra
+                pairs = zip(data['extra_keys'].tolist(),
+                            data['extra_vals'].tolist())
+                if extra:
+                    for key, val in pairs:
+                        extra[key] = extra.get(key, 0) + val
+                else:
+                    # Fresh tree: bulk-assign instead of merging one by one
+                    extra.update(pairs)
+        else:
+            # Old pickled trees; int-keyed ones merge, pre-zobrist ones raise
+            with _open_maybe_gzip(path) as f:
+                self.htree += pickle.load(f)
+
+
+# The searcher the forked root workers inherit; set by Expectimax.search
+# just before the fork, so it never has to be pickled.
+_root_searcher = None
+
+
+def _init_root_worker():
+    # The engine handles inherited from the parent belong to the parent's
+    # processes, so each worker opens a single fresh engine of its own.
+    engine = Engine(_root_searcher.engine.ucipath,
+                    _root_searcher.engine.search_time, 1)
+    engine.start()
+    _root_searcher.engine = engine
+
+
+def _search_root_move(uci):
+    board = ZobristBoard()
+    board.push(chess.Move.from_uci(uci))
+    score = _root_searcher._search_subtree(board)
+    return score, _root_searcher.etree
 
 
 class Expectimax:
-    def __init__(self, engine, database, color, treshold):
+    def __init__(self, engine, database, color, treshold, min_mass=0):
         self.engine = engine
         self.treshold = treshold
+        self.min_mass = min_mass
         self.database = database
         self.color = chess.WHITE if color == 'white' else chess.BLACK
         self.etree = {}
+        self._stats_cache = {}
+        self._probs_cache = {}
+        self._san_cache = {}
+        self._nlog_cache = {}
 
     def search(self):
         """ Travels the tree top-down, evaluating the scores, storing them in etree """
         if self.color == chess.WHITE:
-            self.__search(chess.Board())
+            self.__search(ZobristBoard())
         else:
-            board = chess.Board()
+            board = ZobristBoard()
+            replies = self.most_common(board)
             score = 0
-            for p, move in self.most_common(board):
-                board.push(move)
-                score += p*self.__search(board)
-                board.pop()
-            self.etree[board._transposition_key()] = (None, score)
+            workers = min(len(replies), getattr(self.engine, 'threads', 0))
+            if workers > 1:
+                # The subtrees under the opponent's opening moves are
+                # independent, so fork a worker per engine process and merge
+                # the etrees afterwards. Transpositions across subtrees get
+                # searched twice and resolved last-write-wins, which is fine:
+                # both writes hold a valid score for the position.
+                global _root_searcher
+                _root_searcher = self
+                ctx = multiprocessing.get_context('fork')
+                with ctx.Pool(workers, initializer=_init_root_worker) as pool:
+                    vals = pool.map(_search_root_move,
+                                    [move.uci() for _, move in replies])
+                _root_searcher = None
+                for (p, move), (val, etree) in zip(replies, vals):
+                    score += p*val
+                    self.etree.update(etree)
+            else:
+                for p, move in replies:
+                    board.push(move)
+                    score += p*self.__search(board)
+                    board.pop()
+            self.etree[board.zob_key] = _pack_value(None, score)
         # search uses \r, so we want a free line to keep the last output
         print()
 
+    def _search_subtree(self, board):
+        """ Entry point for the forked root workers. """
+        return self.__search(board)
+
     def __search(self, board):
+        """
+        Drives __search_step with an explicit stack of generators rather than
+        Python recursion. The opening tree is deep, and this frees us from
+        per-frame call overhead and the recursion limit, besides making it
+        easy to reorder or batch pending work later.
+        """
+        stack = [self.__search_step(board)]
+        value = None
+        etree_get = self.etree.get # Bound locally, one lookup per tree edge
+        while stack:
+            try:
+                child = stack[-1].send(value)
+            except StopIteration as stop:
+                value = stop.value
+                stack.pop()
+            else:
+                # Cached children are resolved right here, without even
+                # paying for a generator frame.
+                hit = etree_get(child.zob_key)
+                if hit is not None and hit != OPEN:
+                    value = _value_score(hit)
+                else:
+                    value = None
+                    stack.append(self.__search_step(child))
+        return value
+
+    def __search_step(self, board):
         """
         Perform expectimax. Could also use mcts.
-        Search is always called from the perspective of ourselves
+        Search is always called from the perspective of ourselves.
+        Written as a generator: yielding a board means "search this child
+        position for me"; the driver sends the resulting score back in.
         """
 
-        root_key = board._transposition_key()
+        root_key = board.zob_key
 
-        if root_key in self.etree:
-            value = self.etree[root_key]
+        # A single probe covers both membership and value; the driver does
+        # the same for cached children.
+        value = self.etree.get(root_key)
+        if value is not None:
             # We could be going in a circle.
             # No reason to break this in the probabilistically correct way
-            if value == 'open':
+            if value == OPEN:
                 move, score = self.engine.evaluate(board)
                 # We don't store "None" moves in the etree.
                 # That would confuse us later on.
                 if move is not None:
-                    self.etree[root_key] = (move, score)
+                    self.etree[root_key] = _pack_value(move, score)
                 return score
-            best_move, best_score = value
-            return best_score
-        else:
-            self.etree[root_key] = 'open'
+            return _value_score(value)
+        self.etree[root_key] = OPEN
 
-        if self.database.get_board_count(board) < self.treshold:
+        if self.database.count(root_key) < self.treshold:
             move, score = self.engine.evaluate(board)
             if move is not None:
-                self.etree[root_key] = (move, score)
+                self.etree[root_key] = _pack_value(move, score)
             return score
 
         print(self.engine.evals, '...', end='\r')
 
-        best_move, best_score = None, -1
-        for move in board.legal_moves:
+        # First pass: compute each child's key and count once, and collect
+        # the positions too rare to expand, so their engine evaluations can
+        # run in parallel over the engine pool rather than one blocking uci
+        # round-trip at a time. We look two plies ahead: our own leaf
+        # children, and the rare positions behind each opponent reply we are
+        # going to visit anyway.
+        our_moves, _ = self._move_stats(board)
+        children = [] # (move, child key, child count, opponent replies)
+        leaf_boards = []
+        pending = set()
+        for move in our_moves:
             board.push(move)
-            if self.database.get_board_count(board) < self.treshold:
+            child_key = board.zob_key
+            child_cnt = self.database.count(child_key)
+            if child_cnt < self.treshold:
+                children.append((move, child_key, child_cnt, None))
+                # Opening positions transpose a lot (1.Nf3 d5 2.d4 is 1.d4 d5
+                # 2.Nf3), so a sibling elsewhere in the tree may already have
+                # paid the engine call for this exact position.
+                if child_key not in self.etree and child_key not in pending:
+                    pending.add(child_key)
+                    leaf_boards.append(board.copy(stack=False))
+            else:
+                replies = self.__pick_replies(board)
+                children.append((move, child_key, child_cnt, replies))
+                gc_keys = []
+                for opp_move, _ in replies:
+                    board.push(opp_move)
+                    gc_keys.append(board.zob_key)
+                    board.pop()
+                # One batched lookup for the whole reply fan
+                for (opp_move, _), gc_key, gc_cnt in zip(
+                        replies, gc_keys, self.database.counts(gc_keys)):
+                    if (gc_cnt < self.treshold
+                            and gc_key not in self.etree
+                            and gc_key not in pending):
+                        pending.add(gc_key)
+                        board.push(opp_move)
+                        leaf_boards.append(board.copy(stack=False))
+                        board.pop()
+            board.pop()
+        leaf_scores = dict(zip((b.zob_key for b in leaf_boards),
+                               self.engine.evaluate_many(leaf_boards)))
+        # We don't store "None" moves in the etree.
+        # That would confuse us later on.
+        for child_key, (move, score) in leaf_scores.items():
+            if move is not None:
+                self.etree[child_key] = _pack_value(move, score)
+
+        # Children already scored in the etree (transpositions, or a resumed
+        # run) cost nothing to visit, so take them first to seed best_score,
+        # then popular moves, which are usually the strong ones. Both let
+        # the bound below cut more.
+        children.sort(key=lambda c: (c[1] in self.etree, c[2]), reverse=True)
+
+        best_move, best_score = None, -1
+        for move, child_key, child_cnt, replies in children:
+            if child_cnt < self.treshold:
                 # After applying our move, evaluate gives the score from
                 # the perspective of our opponent, so we negate it.
-                # TODO: Should we cache this?
-                _, mscore = self.engine.evaluate(board)
+                # Leaf children don't even need the move pushed.
+                if child_key in leaf_scores:
+                    _, mscore = leaf_scores[child_key]
+                else:
+                    mscore = _value_score(self.etree[child_key])
                 score = -mscore
             else:
+                board.push(move)
+                total = sum(cnt for _, cnt in replies)
                 score = 0
                 denom = 0
-                for opp_move in board.legal_moves:
+                for opp_move, move_cnt in replies:
+                    # *-minimax bound (Ballard 1983): even if every reply we
+                    # still have to visit scored a full win, the expectation
+                    # can no longer beat best_score, so stop searching it.
+                    if best_move is not None and score + (total - denom) < best_score * total:
+                        score = None
+                        break
                     board.push(opp_move)
-                    val = self.__search(board)
+                    val = yield board
                     board.pop()
-                    # We use a Laplace smoothing, adding 1 to each move.
-                    move_cnt = self.database.get_move_count(board, opp_move) + 1
                     score += val * move_cnt
                     denom += move_cnt
+                board.pop()
+                if score is None:
+                    continue
                 score /= denom
-            board.pop()
             # From our own perspective, we always pick the best move.
             # Expecti-max style.
             if score >= best_score:
                 best_move = move
                 best_score = score
 
-        self.etree[root_key] = (best_move, best_score)
+        self.etree[root_key] = _pack_value(best_move, best_score)
         return best_score
 
+    def __pick_replies(self, board):
+        """
+        The opponent replies we will actually visit, as (move, smoothed
+        count) pairs. Common replies come first, so we can cut the rare
+        tail once its remaining probability mass is negligible. Those
+        branches cost a full subtree of engine calls each, but barely
+        move the expectation. The count-descending order also feeds the
+        star-minimax bound in the caller, which cuts a whole move once
+        even a perfect tail couldn't make it best.
+        """
+        opp_moves, opp_counts = self._move_stats(board)
+        order = sorted(range(len(opp_moves)),
+                       key=opp_counts.__getitem__, reverse=True)
+        # We use a Laplace smoothing, adding 1 to each move.
+        denom_total = sum(opp_counts) + len(opp_counts)
+        replies = []
+        denom = 0
+        for i in order:
+            if denom and denom_total - denom < self.min_mass * denom_total:
+                break
+            replies.append((opp_moves[i], opp_counts[i] + 1))
+            denom += opp_counts[i] + 1
+        return replies
+
     def make_pgn(self, n):
         """ Makes a pgn, including the `n` most common nodes of the tree. """
         game = chess.pgn.Game()
@@ -211,71 +1012,102 @@ class Expectimax:
         return game
 
     def __inner_make_pgn(self, pv_tree, node):
-        for score_or_p, move, subtree in pv_tree:
-            if move is None:
-                # This only happens at the root, and only when we're black
-                node.comment = f'Score: {2*score_or_p-1:.2f}'
-                new_node = node
-            else:
-                board = node.board()
-                new_node = node.add_variation(move)
-                if board.turn == self.color:
-                    new_node.comment = f'Score: {2*score_or_p-1:.2f}'
+        # An explicit walk rather than recursion; large --treesize values
+        # make these trees deeper than Python recursion is comfortable with.
+        stack = [(pv_tree, node)]
+        while stack:
+            subtrees, node = stack.pop()
+            for score_or_p, move, subtree in subtrees:
+                if move is None:
+                    # This only happens at the root, and only when we're black
+                    node.comment = f'Score: {2*score_or_p-1:.2f}'
+                    new_node = node
                 else:
-                    new_node.comment = f'Probability: {score_or_p:.2f}'
-            self.__inner_make_pgn(subtree, new_node)
+                    board = node.board()
+                    new_node = node.add_variation(move)
+                    if board.turn == self.color:
+                        new_node.comment = f'Score: {2*score_or_p-1:.2f}'
+                    else:
+                        new_node.comment = f'Probability: {score_or_p:.2f}'
+                stack.append((subtree, new_node))
 
     def print_pv_tree(self, n):
-        self.__inner_pv_tree(self.__make_pv_tree(n), chess.Board(), indent='',
+        self.__inner_pv_tree(self.__make_pv_tree(n), ZobristBoard(), indent='',
                              has_siblings=False)
 
     def __inner_pv_tree(self, pv_tree, board, indent, has_siblings):
-        for p, move, subtree in pv_tree:
+        # A pre-order walk on an explicit stack, like __inner_make_pgn.
+        # A None work item pops the board on the way back up.
+        stack = [(node, indent, has_siblings) for node in reversed(pv_tree)]
+        while stack:
+            item = stack.pop()
+            if item is None:
+                board.pop()
+                continue
+            (p, move, subtree), indent, has_siblings = item
             if move is None:
                 # This only happens at the root, and only when we're black
                 print(indent, f'Score: {p:.2f}')
             else:
                 if board.turn == self.color:
-                    print(indent, f'{board.san(move)}. Score: {2*p-1:.2f}')
+                    print(indent, f'{self._san(board, move)}. Score: {2*p-1:.2f}')
                 else:
-                    print(indent, f'{board.san(move)} (p={p:.2f})')
+                    print(indent, f'{self._san(board, move)} (p={p:.2f})')
                 board.push(move)
+                stack.append(None)
             subindent = indent + (' | ' if has_siblings else ' '*3)
-            self.__inner_pv_tree(subtree, board, subindent,
-                                 has_siblings=len(subtree) > 1)
-            if move is not None:
-                board.pop()
+            stack += [(node, subindent, len(subtree) > 1)
+                      for node in reversed(subtree)]
 
     def __make_pv_tree(self, n):
         """
         Only incluedes the `n` most likely nodes in the tree.
         """
-        q = [] # (-logp, p, random, move, board, tree-where-it-should-live)
+        q = [] # (-logp, tiebreak, p, move, path, tree-where-it-should-live)
         tree = []
-        self.__push_children(q, tree, 0, chess.Board())
+        board = ZobristBoard()
+        # Ties in -logp are broken first-pushed-first, which both avoids
+        # comparing Move objects and makes the tree deterministic, unlike the
+        # random.random() tiebreak we used before.
+        tiebreak = itertools.count()
+        self.__push_children(q, tree, 0, board, tiebreak)
 
+        cur = ()  # the path currently replayed on the board
         while n != 0 and q:
             # Get and add node from heap
-            mlogp, _, p, move, board, subtree = heapq.heappop(q)
+            mlogp, _, p, move, path, subtree = heapq.heappop(q)
             sub2tree = []
             # It's kinda odd: Here I add (p, move, subtree), but
             # in __push_children I add (score, move, ...). Probably this can
             # be done more elegantly.
             subtree.append((p, move, sub2tree))
-            self.__push_children(q, sub2tree, mlogp, board)
+            # Heap entries only store the move path from the root, replayed on
+            # a single reusable board. Consecutive pops usually share a long
+            # opening, so only unwind to the common prefix and push the rest.
+            i = 0
+            while i < len(cur) and i < len(path) and cur[i] == path[i]:
+                i += 1
+            for _ in range(len(cur) - i):
+                board.pop()
+            for m in path[i:]:
+                board.push(m)
+            cur = path
+            self.__push_children(q, sub2tree, mlogp, board, tiebreak)
             n -= 1
 
         return tree
 
-    def __push_children(self, q, tree, mlogp, board):
+    def __push_children(self, q, tree, mlogp, board, tiebreak):
         """ Let board be a node with our turn to play.
             Adds (score, move, subtree) to the tree, and then pushes all follow up
             moves to the heap with a reference to the subtree, so they can be expanded
             later on. """
         # Get and add response node
-        key = board._transposition_key()
-        if key not in self.etree: return
-        move, score = self.etree[key]
+        key = board.zob_key
+        value = self.etree.get(key)
+        # OPEN marks a cycle the search never closed; nothing to print there.
+        if value is None or value == OPEN: return
+        move, score = _value_move(value), _value_score(value)
         #if move is None and not ignore_none: return
         subtree = []
         tree.append((score, move, subtree))
@@ -283,33 +1115,109 @@ class Expectimax:
         # from black to white) so we don't push it.
         if move is not None:
             board.push(move)
+        path = tuple(board.move_stack)
         # Add response-response nodes to heap
-        for pp, move in self.most_common(board):
-            board.push(move)
-            heapq.heappush(q, (mlogp - math.log(pp), random.random(), pp, move, board.copy(), subtree))
+        heappush = heapq.heappush
+        # Transpositions revisit the same (position, move) pairs, so the
+        # -log(p) terms are memoized under the usual composite move keys.
+        nlogs, ckey = self._nlog_cache, board.zob_key
+        for pp, pmove in self.most_common(board):
+            mk = move_key(ckey, pmove)
+            nlogp = nlogs.get(mk)
+            if nlogp is None:
+                nlogp = nlogs[mk] = -math.log(pp)
+            # Path probabilities are nested, not disjoint, so there is no
+            # sound per-node probability floor here: rare nodes can still be
+            # among the n most likely when the frontier is narrow.
+            heappush(q, (mlogp + nlogp, next(tiebreak), pp,
+                         pmove, path + (pmove,), subtree))
+        if move is not None:
             board.pop()
 
+    def _san(self, board, move):
+        """ board.san regenerates all legal moves to disambiguate, and the
+            printers revisit the same positions across trees, so cache by
+            (position, move). A variation_san batch doesn't fit here: siblings
+            fan out from one position rather than following a single line. """
+        key = (board.zob_key, move)
+        san = self._san_cache.get(key)
+        if san is None:
+            san = self._san_cache[key] = board.san(move)
+        return san
+
+    def _move_stats(self, board):
+        """ Returns parallel tuples (legal moves, play counts) for the given
+            position, cached by Zobrist key. The search and the pv tree visit
+            the same positions over and over, and move generation is one of
+            the more expensive parts of python-chess. The cache only ever
+            holds expanded nodes, of which the treshold allows a few hundred
+            thousand at most, so no eviction is needed. """
+        key = board.zob_key
+        stats = self._stats_cache.get(key)
+        if stats is None:
+            moves = tuple(board.legal_moves)
+            # One vectorized lookup for the whole move fan, rather than a
+            # segment probe per move.
+            counts = tuple(self.database.move_counts(key, moves).tolist())
+            stats = self._stats_cache[key] = (moves, counts)
+        return stats
+
     def most_common(self, board):
         """ Returns a list of (proability of play, move) pairs for the given position,
             based on the used GameDatabase. """
-        res = []
-        total = 0
-        for move in board.legal_moves:
-            cnt = self.database.get_move_count(board, move)
-            if cnt != 0:
-                res.append((cnt, move))
-                total += cnt
-        res = [(cnt/total, move) for cnt, move in res]
-        res.sort(reverse=True, key=lambda ab: ab[0])
+        key = board.zob_key
+        res = self._probs_cache.get(key)
+        if res is None:
+            moves, counts = self._move_stats(board)
+            carr = np.fromiter(counts, dtype=np.int64, count=len(counts))
+            total = int(carr.sum())
+            res = []
+            # argsort in C instead of a python sort with a lambda key; the
+            # stable kind keeps ties in generation order like before.
+            for i in np.argsort(-carr, kind='stable').tolist():
+                if not counts[i]:
+                    break
+                res.append((counts[i]/total, moves[i]))
+            self._probs_cache[key] = res
         return res
 
     def load(self, path):
         with open(path, 'rb') as f:
-            self.etree = pickle.load(f)
+            magic = f.read(2)
+        if magic == b'PK':
+            with np.load(path) as data:
+                scores = data['scores']
+                if scores.dtype == np.int16:
+                    # q15 fixed point; a score is a win probability, so the
+                    # ~3e-5 quantization step is far below engine noise.
+                    scores = scores.astype(np.float32) / np.float32(32767)
+                # The in-memory packing matches the file layout, so values
+                # are rebuilt with two vectorized shifts.
+                values = (data['moves'].astype(np.uint64) << np.uint64(32)
+                          | scores.view(np.uint32).astype(np.uint64))
+                self.etree = dict(zip(data['keys'].tolist(), values.tolist()))
+        else:
+            # Old pickled trees with (move, score) tuple values
+            with _open_maybe_gzip(path) as f:
+                old = pickle.load(f)
+            self.etree = {key: OPEN if val == 'open' else _pack_value(*val)
+                          for key, val in old.items()}
 
     def dump(self, path):
+        # Unfinished OPEN markers are transient, so they aren't saved.
+        items = [(key, val) for key, val in self.etree.items() if val != OPEN]
+        vals = np.fromiter((val for _, val in items),
+                           dtype=np.uint64, count=len(items))
+        scores = (vals & np.uint64(0xFFFFFFFF)).astype(np.uint32).view(np.float32)
         with open(path, 'wb') as f:
-            pickle.dump(self.etree, f)
+            np.savez_compressed(
+                f,
+                keys=np.fromiter((key for key, _ in items),
+                                 dtype=np.uint64, count=len(items)),
+                moves=(vals >> np.uint64(32)).astype(np.uint16),
+                # Scores live in [-1, 1], so q15 fixed point halves the
+                # column; load() still reads the old float32 dumps too.
+                scores=np.round(np.clip(scores, -1, 1) * 32767).astype(np.int16))
 
 
 class ChessOpeningsExpectimax:
@@ -320,8 +1228,9 @@ class ChessOpeningsExpectimax:
         parser.add_argument('--engine', help='Engine path')
         parser.add_argument('--games', default=10**6, type=int, help='Maximum number of games to use from each month')
         parser.add_argument('--treshold', default=100, type=int, help='Minimum visits on nodes to expand')
+        parser.add_argument('--min-mass', default=0, type=float, help='Skip the rarest opponent replies once their remaining probability mass is below this fraction')
         parser.add_argument('--ms', default=50, type=int, help='Miliseconds to search each leaf node')
-        parser.add_argument('--threads', default=4, type=int, help='Threads to use for engine')
+        parser.add_argument('--threads', default=os.cpu_count() or 4, type=int, help='Engine processes to run in parallel (default: one per core)')
         parser.add_argument('--treesize', default=50, type=int, help='Number of nodes to include in pv tree')
         parser.add_argument('--color', default='white', type=str, help='Side from which to analyze')
         parser.add_argument('--min-rating', default=0, type=int, help='Lowest rating for players')
@@ -352,7 +1261,8 @@ class ChessOpeningsExpectimax:
         etree_path = f'etree_{arg_str}.pkl'
         analysis_path = f'analysis_{arg_str}.pgn'
         engine = Engine(args.engine, args.ms/1000, args.threads)
-        searcher = Expectimax(engine, database, args.color, args.treshold)
+        searcher = Expectimax(engine, database, args.color, args.treshold,
+                              args.min_mass)
 
         def header_filter(headers):
             welo, belo = headers['WhiteElo'], headers['BlackElo']
@@ -397,7 +1307,10 @@ class ChessOpeningsExpectimax:
         else:
             engine.start()
             print(f'Making engine tree for {args.color}...')
-            searcher.search()
+            try:
+                searcher.search()
+            finally:
+                engine.quit()
             print(f'Saving to {etree_path}...')
             searcher.dump(etree_path)
 